@@ -0,0 +1,24 @@
+"""
+PulmoScan AI — Gunicorn configuration
+Usage: PORT=5001 gunicorn -c gunicorn_conf.py inference_api:app
+"""
+
+import os
+import threading
+
+bind         = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+workers      = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+worker_class = "gthread"
+threads      = 4
+timeout      = 60
+
+# Import the app once in the master, then fork: module-level state is shared
+# copy-on-write across workers instead of being rebuilt in each one
+preload_app  = True
+
+
+def post_fork(server, worker):
+    # Warm up in each worker (not the master) so pooled sockets aren't shared;
+    # in the background so worker boot isn't held up by the network
+    from inference_api import warmup
+    threading.Thread(target=warmup, daemon=True).start()
@@ -7,12 +7,19 @@ Mobile photos rejected via EXIF camera detection
 
 import os
 import io
+import hashlib
 import logging
+import threading
+import orjson
 import requests
 import numpy as np
+from types import MappingProxyType
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
 from PIL import Image
 from PIL.ExifTags import TAGS
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 
 logging.basicConfig(level=logging.INFO,
@@ -21,45 +28,60 @@ logger = logging.getLogger(__name__)
 
 PORT = int(os.environ.get("PORT", 10000))
 
+class OrjsonProvider(JSONProvider):
+    """jsonify() through orjson's C encoder instead of the stdlib json module."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app, origins=["*"])
 
-CLASSES = ["Normal", "Pneumonia", "Lung Opacity"]
+CLASSES = ("Normal", "Pneumonia", "Lung Opacity")
 
 HF_API_URL = "https://api-inference.huggingface.co/models/nickmuchi/vit-finetuned-chest-xray-pneumonia"
 HF_TOKEN   = os.environ.get("HF_TOKEN", "")
+HF_CACHE_SIZE = 128   # recent uploads whose HF results are kept in memory
 
-CLINICAL = {
-    "Normal": {
+VALIDATION_SIZE = 512  # min edge JPEGs are decoded to for validation stats
+
+# Read-only at every level: shared by all request threads
+CLINICAL = MappingProxyType({
+    "Normal": MappingProxyType({
         "severity": "Low",
-        "regions": [],
-        "recommendations": [
+        "regions": (),
+        "recommendations": (
             "No significant abnormalities detected",
             "Continue regular health checkups every 12 months",
             "Maintain healthy lifestyle habits",
-        ],
-    },
-    "Pneumonia": {
+        ),
+    }),
+    "Pneumonia": MappingProxyType({
         "severity": "Medium",
-        "regions": ["Right lower lobe", "Left lower lobe"],
-        "recommendations": [
+        "regions": ("Right lower lobe", "Left lower lobe"),
+        "recommendations": (
             "Consult a pulmonologist immediately",
             "Complete course of prescribed antibiotics",
             "Rest and stay well-hydrated",
             "Follow-up chest X-ray in 2-4 weeks",
-        ],
-    },
-    "Lung Opacity": {
+        ),
+    }),
+    "Lung Opacity": MappingProxyType({
         "severity": "Medium",
-        "regions": ["Left upper lobe", "Perihilar region"],
-        "recommendations": [
+        "regions": ("Left upper lobe", "Perihilar region"),
+        "recommendations": (
             "Further HRCT imaging is recommended",
             "Refer to pulmonologist for specialist evaluation",
             "Sputum culture to rule out bacterial/fungal infection",
             "Consider bronchoscopy if lesion persists",
-        ],
-    },
-}
+        ),
+    }),
+})
 
 
 # ─── STRICT X-RAY VALIDATION ─────────────────────────────────────────────────
@@ -72,10 +94,15 @@ def is_valid_chest_xray(image_bytes):
     Returns: (bool, str) — (is_valid, reason_if_invalid)
     """
     try:
-        img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-        img_array = np.array(img, dtype=np.float32)
+        # Parse the upload once; the same handle serves EXIF and pixel checks
+        img_raw = Image.open(io.BytesIO(image_bytes))
+        width, height = img_raw.size
 
-        width, height = img.size
+        # Large JPEGs are decoded at a reduced DCT scale (1/2, 1/4, 1/8);
+        # the pixel statistics below don't need full resolution
+        img_raw.draft("RGB", (VALIDATION_SIZE, VALIDATION_SIZE))
+        img = img_raw.convert("RGB")
+        img_array = np.asarray(img)  # uint8 view, no float32 copy
 
         # ── Check 1: Minimum image size ──────────────────────────────────────
         if width < 100 or height < 100:
@@ -85,7 +112,6 @@ def is_valid_chest_xray(image_bytes):
         # Mobile phone photos always have camera EXIF data
         # Real X-ray images from medical scanners never have camera EXIF
         try:
-            img_raw = Image.open(io.BytesIO(image_bytes))
             exif_data = img_raw._getexif()
             if exif_data:
                 camera_make  = exif_data.get(271, '')  # Tag 271 = Make
@@ -122,9 +148,16 @@ def is_valid_chest_xray(image_bytes):
         g = img_array[:, :, 1]
         b = img_array[:, :, 2]
 
-        rg_diff = np.mean(np.abs(r - g))
-        rb_diff = np.mean(np.abs(r - b))
-        gb_diff = np.mean(np.abs(g - b))
+        # Reuse one scratch buffer instead of allocating per subtraction
+        diff = np.empty(r.shape, dtype=np.int16)
+
+        def mean_abs_diff(x, y):
+            np.subtract(x, y, out=diff, dtype=np.int16)
+            return np.mean(np.abs(diff, out=diff))
+
+        rg_diff = mean_abs_diff(r, g)
+        rb_diff = mean_abs_diff(r, b)
+        gb_diff = mean_abs_diff(g, b)
         avg_color_diff = (rg_diff + rb_diff + gb_diff) / 3
 
         # Strict threshold: 15 (selfies have color diff of 20-50+)
@@ -133,16 +166,19 @@ def is_valid_chest_xray(image_bytes):
             return False, "Image appears to be a color photograph, not an X-ray"
 
         # ── Check 5: Per-pixel saturation check ──────────────────────────────
-        max_channel = np.maximum(np.maximum(r, g), b)
-        min_channel = np.minimum(np.minimum(r, g), b)
-        avg_saturation = np.mean(max_channel - min_channel)
+        max_channel = np.maximum(r, g)
+        np.maximum(max_channel, b, out=max_channel)
+        min_channel = np.minimum(r, g)
+        np.minimum(min_channel, b, out=min_channel)
+        avg_saturation = np.mean(np.subtract(max_channel, min_channel,
+                                             out=max_channel))
 
         if avg_saturation > 20:
             logger.info(f"Validation failed: saturation {avg_saturation:.2f}")
             return False, "Image has too much color saturation for an X-ray"
 
         # ── Check 6: Pixel intensity range ───────────────────────────────────
-        gray = np.mean(img_array, axis=2)
+        gray = np.mean(img_array, axis=2, dtype=np.float32)
         mean_intensity = np.mean(gray)
         std_intensity  = np.std(gray)
 
@@ -159,13 +195,13 @@ def is_valid_chest_xray(image_bytes):
             return False, "Image has insufficient contrast for a chest X-ray"
 
         # ── Check 7: Dark pixel ratio ─────────────────────────────────────────
-        dark_ratio = np.sum(gray < 128) / gray.size
+        dark_ratio = np.count_nonzero(gray < 128) / gray.size
         if dark_ratio < 0.15 or dark_ratio > 0.95:
             logger.info(f"Validation failed: dark ratio {dark_ratio:.2f}")
             return False, "Pixel distribution does not match a chest X-ray pattern"
 
         # ── Check 8: Highlight pixel ratio ───────────────────────────────────
-        highlight_ratio = np.sum(gray > 240) / gray.size
+        highlight_ratio = np.count_nonzero(gray > 240) / gray.size
         if highlight_ratio > 0.25:
             logger.info(f"Validation failed: highlight ratio {highlight_ratio:.2f}")
             return False, "Too many bright pixels for a chest X-ray"
@@ -185,50 +221,101 @@ def is_valid_chest_xray(image_bytes):
 
 # ─── HuggingFace API ──────────────────────────────────────────────────────────
 
-def call_hf_api(image_bytes):
-    headers = {}
+def make_hf_session():
+    """Keep-alive session so repeat calls skip the TCP + TLS handshake."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
     if HF_TOKEN:
-        headers["Authorization"] = f"Bearer {HF_TOKEN}"
-    response = requests.post(HF_API_URL, headers=headers, data=image_bytes, timeout=30)
+        session.headers["Authorization"] = f"Bearer {HF_TOKEN}"
+    return session
+
+
+_hf_session    = make_hf_session()
+_hf_cache      = OrderedDict()
+_hf_cache_lock = threading.Lock()
+
+
+def call_hf_api(image_bytes):
+    # Identical re-uploads are answered from a small in-process LRU
+    key = hashlib.blake2b(image_bytes, digest_size=16).digest()
+    with _hf_cache_lock:
+        if key in _hf_cache:
+            _hf_cache.move_to_end(key)
+            return _hf_cache[key]
+
+    response = _hf_session.post(HF_API_URL, data=image_bytes, timeout=30)
     response.raise_for_status()
-    return response.json()
+    result = response.json()
 
+    # HF can answer 200 with e.g. {"error": "Model loading"}; never cache that
+    if not (isinstance(result, list) and result and
+            all(isinstance(r, dict) and "label" in r and "score" in r for r in result)):
+        raise ValueError(f"Unexpected HF API response: {str(result)[:200]}")
 
-def map_to_three_classes(hf_results):
-    raw_probs = {r["label"].upper(): float(r["score"]) for r in hf_results}
-    normal_prob    = raw_probs.get("NORMAL",    0.5)
-    pneumonia_prob = raw_probs.get("PNEUMONIA", 0.5)
-
-    total = normal_prob + pneumonia_prob
-    if total == 0:
-        total = 1.0
-    normal_prob    = normal_prob    / total
-    pneumonia_prob = pneumonia_prob / total
-
-    if pneumonia_prob > 0.6:
-        lung_opacity_prob = pneumonia_prob * 0.3
-        pneumonia_prob    = pneumonia_prob * 0.7
-    elif pneumonia_prob > 0.4:
-        lung_opacity_prob = pneumonia_prob * 0.2
-        pneumonia_prob    = pneumonia_prob * 0.8
+    with _hf_cache_lock:
+        _hf_cache[key] = result
+        if len(_hf_cache) > HF_CACHE_SIZE:
+            _hf_cache.popitem(last=False)
+    return result
+
+
+def warmup():
+    """
+    Pay first-request costs at startup: open the pooled TLS connection to
+    HuggingFace and run the validator once so PIL/NumPy paths are loaded.
+    Runs per process (after fork under gunicorn) so sockets aren't shared.
+    """
+    try:
+        buf = io.BytesIO()
+        Image.linear_gradient("L").resize((256, 256)).save(buf, format="JPEG")
+        is_valid_chest_xray(buf.getvalue())
+        _hf_session.get(HF_API_URL, timeout=10).close()
+        logger.info("Warmup done")
+    except Exception as e:
+        logger.warning(f"Warmup incomplete ({e})")
+
+
+def _map3(n, p):
+    """(normal, pneumonia) binary scores → normalized (normal, pneumonia, lung_opacity)."""
+    t = n + p
+    if t == 0:
+        t = 1.0
+    n /= t
+    p /= t
+
+    if p > 0.6:
+        lo = p * 0.3
+        p *= 0.7
+    elif p > 0.4:
+        lo = p * 0.2
+        p *= 0.8
     else:
-        lung_opacity_prob = 0.05
-        normal_prob       = max(0, normal_prob - 0.05)
-
-    probabilities = {
-        "Normal":       round(normal_prob,      4),
-        "Pneumonia":    round(pneumonia_prob,    4),
-        "Lung Opacity": round(lung_opacity_prob, 4),
-    }
-    s = sum(probabilities.values())
-    probabilities = {k: round(v / s, 4) for k, v in probabilities.items()}
-    return probabilities
+        lo = 0.05
+        n = max(0.0, n - 0.05)
+
+    s = n + p + lo
+    return n / s, p / s, lo / s
+
+
+def map_to_three_classes(hf_results):
+    normal_prob = pneumonia_prob = 0.5
+    for r in hf_results:
+        label = r["label"].upper()
+        if label == "NORMAL":
+            normal_prob = float(r["score"])
+        elif label == "PNEUMONIA":
+            pneumonia_prob = float(r["score"])
+
+    # Ordered as CLASSES; rounded once, argmax over the raw scalars
+    p = _map3(normal_prob, pneumonia_prob)
+    idx = max(range(3), key=p.__getitem__)
+    probabilities = {cls: round(v, 4) for cls, v in zip(CLASSES, p)}
+    return CLASSES[idx], probabilities[CLASSES[idx]], probabilities
 
 
 def demo_predict(image_bytes):
     """Fallback demo prediction when HF API is unavailable."""
-    import hashlib
-    h = int(hashlib.md5(image_bytes[:100]).hexdigest(), 16)
+    h = int.from_bytes(hashlib.blake2b(image_bytes[:100], digest_size=8).digest(), "big")
     idx = h % 3
     cls = CLASSES[idx]
     conf = 0.75 + (h % 20) / 100
@@ -279,11 +366,9 @@ def predict():
 
     # STEP 2: Run AI inference only for valid X-rays
     try:
-        hf_results    = call_hf_api(image_bytes)
-        probabilities = map_to_three_classes(hf_results)
-        pred_class    = max(probabilities, key=probabilities.get)
-        confidence    = probabilities[pred_class]
-        demo_mode     = False
+        hf_results = call_hf_api(image_bytes)
+        pred_class, confidence, probabilities = map_to_three_classes(hf_results)
+        demo_mode  = False
         logger.info(f"HF API prediction: {pred_class} ({confidence:.1%})")
     except Exception as e:
         logger.warning(f"HF API failed ({e}), using demo mode")
@@ -306,4 +391,5 @@ def predict():
 
 if __name__ == "__main__":
     logger.info(f"Starting PulmoScan AI on port {PORT}")
+    warmup()
     app.run(host="0.0.0.0", port=PORT, debug=False)
@@ -5,38 +5,33 @@ Classes: Normal, Pneumonia, Lung Opacity
 
 import os
 import shutil
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 CHEXPERT_ROOT = r"D:\CheXpert-v1.0-small"
 OUTPUT_DIR    = r".\data"
 MAX_PER_CLASS = 3000
+COPY_WORKERS  = 16
 
 CLASSES = ["Normal", "Pneumonia", "Lung Opacity"]
 
-def get_label(row) -> str:
-    def pos(col):
-        try:
-            return float(row.get(col, 0)) == 1.0
-        except:
-            return False
-
-    def uncertain(col):
-        try:
-            return float(row.get(col, 0)) == -1.0
-        except:
-            return False
-
-    if pos("Pneumonia") or uncertain("Pneumonia"):
-        return "Pneumonia"
-    if pos("Lung Opacity") or uncertain("Lung Opacity"):
-        return "Lung Opacity"
-    try:
-        if float(row.get("No Finding", 0)) == 1.0:
-            return "Normal"
-    except:
-        pass
-    return None
+def _column(df, col):
+    """Numeric view of a label column; missing or unparsable cells become 0."""
+    if col not in df.columns:
+        return pd.Series(0.0, index=df.index)
+    return pd.to_numeric(df[col], errors="coerce").fillna(0.0)
+
+def get_labels(df) -> pd.Series:
+    """Vectorized label assignment: Pneumonia > Lung Opacity > Normal."""
+    pneumonia = _column(df, "Pneumonia").isin([1.0, -1.0])
+    opacity   = _column(df, "Lung Opacity").isin([1.0, -1.0])
+    normal    = _column(df, "No Finding").eq(1.0)
+    labels = pd.Series(np.select([pneumonia, opacity, normal],
+                                 ["Pneumonia", "Lung Opacity", "Normal"],
+                                 default=""), index=df.index)
+    return labels.mask(labels == "")
 
 def prepare():
     # Clean old data folders
@@ -58,19 +53,19 @@ def prepare():
     df = pd.read_csv(csv_path)
     print(f"[INFO] Total rows: {len(df)}")
 
+    df["label"] = get_labels(df)
+    skipped = int(df["label"].isna().sum())
+    df = df.dropna(subset=["label"])
+
     counts  = {cls: 0 for cls in CLASSES}
-    skipped = 0
     errors  = 0
+    paths   = df["Path"].fillna("").astype(str)
+    jobs    = []
 
-    for _, row in df.iterrows():
-        label = get_label(row)
-        if label is None:
-            skipped += 1
-            continue
+    for label, raw_path in zip(df["label"].to_numpy(), paths.to_numpy()):
         if counts[label] >= MAX_PER_CLASS:
             continue
 
-        raw_path = str(row.get("Path", ""))
         if not raw_path:
             skipped += 1
             continue
@@ -93,9 +88,14 @@ def prepare():
 
         ext  = os.path.splitext(src)[1]
         dest = os.path.join(OUTPUT_DIR, label, f"{label}_{counts[label]:05d}{ext}")
-        shutil.copy2(src, dest)
+        jobs.append((src, dest))
         counts[label] += 1
 
+    # Copies are I/O-bound; shutil releases the GIL (and uses sendfile on Linux)
+    print(f"[INFO] Copying {len(jobs)} images with {COPY_WORKERS} threads ...")
+    with ThreadPoolExecutor(max_workers=COPY_WORKERS) as pool:
+        list(pool.map(lambda job: shutil.copy2(*job), jobs))
+
     print("\n[DONE] Images copied:")
     total = 0
     for cls in CLASSES:
@@ -1,7 +1,7 @@
 """
 PulmoScan AI — Model Training Script
 Dataset: CheXpert (3 classes: Normal, Pneumonia, Lung Opacity)
-Fix: Grayscale images converted to RGB via color_mode="grayscale" + repeat channels
+Fix: Grayscale images expanded to 3 channels in the tf.data pipeline
 """
 
 import os
@@ -9,7 +9,6 @@ import numpy as np
 import pandas as pd
 import tensorflow as tf
 from tensorflow.keras import layers, models, optimizers, callbacks
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from sklearn.model_selection import train_test_split
 from sklearn.utils.class_weight import compute_class_weight
 from sklearn.metrics import (classification_report, confusion_matrix,
@@ -20,6 +19,7 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import seaborn as sns
 import json
+import hashlib
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -36,15 +36,50 @@ CONFIG = {
     "DATA_DIR":      "./data",
     "MODEL_DIR":     "./saved_model",
     "PLOTS_DIR":     "./plots",
+    "TFRECORD_DIR":  "./tfrecords",
+    "TFRECORD_SHARDS": 8,
     "SEED":          42,
+    "MIXED_PRECISION": True,
 }
 
 os.makedirs(CONFIG["MODEL_DIR"], exist_ok=True)
 os.makedirs(CONFIG["PLOTS_DIR"], exist_ok=True)
+os.makedirs(CONFIG["TFRECORD_DIR"], exist_ok=True)
 tf.random.set_seed(CONFIG["SEED"])
 np.random.seed(CONFIG["SEED"])
 
 
+def cpu_has_native_bf16():
+    """True if the CPU advertises AVX-512 BF16 or AMX-BF16 (Linux only)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = set(f.read().split())
+    except OSError:
+        return False
+    return bool(flags & {"avx512_bf16", "amx_bf16"})
+
+
+def select_precision_policy():
+    """
+    FP16 on GPU tensor cores; BF16 only on CPUs with native BF16 support
+    (emulated BF16 is slower than FP32); float32 everywhere else.
+    """
+    if not CONFIG["MIXED_PRECISION"]:
+        return "float32"
+    if tf.config.list_physical_devices("GPU"):
+        return "mixed_float16"
+    if cpu_has_native_bf16():
+        return "mixed_bfloat16"
+    return "float32"
+
+
+# Variables and the softmax head stay FP32 under either mixed policy
+tf.keras.mixed_precision.set_global_policy(select_precision_policy())
+print(f"[INFO] Precision policy: {tf.keras.mixed_precision.global_policy().name}")
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+
 def build_dataframe(data_dir, classes):
     records = []
     for label in classes:
@@ -75,40 +110,120 @@ def stratified_split(df):
             test_df.reset_index(drop=True))
 
 
-def make_generators(train_df, val_df, test_df):
-    IMG = CONFIG["IMAGE_SIZE"]
-    BS  = CONFIG["BATCH_SIZE"]
+def _load_image(path, label_idx):
+    img = tf.io.decode_image(tf.io.read_file(path), channels=1,
+                             expand_animations=False)
+    img = tf.image.resize(img, CONFIG["IMAGE_SIZE"])
+    # Cached as uint8 so the whole decoded set stays small enough for RAM
+    return tf.saturate_cast(tf.round(img), tf.uint8), label_idx
+
+
+TFRECORD_FEATURES = {
+    "img":   tf.io.FixedLenFeature([], tf.string),
+    "label": tf.io.FixedLenFeature([], tf.int64),
+}
 
-    # Load as grayscale, then stack to 3 channels inside the model
-    train_gen = ImageDataGenerator(
-        rescale=1./255,
-        rotation_range=10,
-        width_shift_range=0.08,
-        height_shift_range=0.08,
-        zoom_range=0.10,
-        horizontal_flip=True,
-        fill_mode="nearest",
-    )
-    eval_gen = ImageDataGenerator(rescale=1./255)
-
-    # color_mode="grayscale" → single channel, we replicate to 3 in the model
-    train_flow = train_gen.flow_from_dataframe(
-        train_df, x_col="filepath", y_col="label",
-        target_size=IMG, batch_size=BS,
-        color_mode="grayscale",
-        class_mode="categorical", shuffle=True, seed=CONFIG["SEED"])
-    val_flow = eval_gen.flow_from_dataframe(
-        val_df, x_col="filepath", y_col="label",
-        target_size=IMG, batch_size=BS,
-        color_mode="grayscale",
-        class_mode="categorical", shuffle=False)
-    test_flow = eval_gen.flow_from_dataframe(
-        test_df, x_col="filepath", y_col="label",
-        target_size=IMG, batch_size=BS,
-        color_mode="grayscale",
-        class_mode="categorical", shuffle=False)
-
-    return train_flow, val_flow, test_flow
+
+def _parse_example(record):
+    ex  = tf.io.parse_single_example(record, TFRECORD_FEATURES)
+    img = tf.io.decode_raw(ex["img"], tf.uint8)
+    return tf.reshape(img, (*CONFIG["IMAGE_SIZE"], 1)), ex["label"]
+
+
+def write_tfrecords(df, split, class_indices):
+    """
+    Decode + resize every image of a split once and store the uint8 tensors
+    in sharded TFRecords. A manifest, written only after every shard is
+    complete, records what the shards hold; they are reused only while it
+    matches this split and the data folders haven't changed since.
+    """
+    n = CONFIG["TFRECORD_SHARDS"]
+    shards = [os.path.join(CONFIG["TFRECORD_DIR"], f"{split}-{i:02d}-of-{n:02d}.tfrecord")
+              for i in range(n)]
+    manifest_path = os.path.join(CONFIG["TFRECORD_DIR"], f"{split}-manifest.json")
+    manifest = {
+        "split":         split,
+        "count":         len(df),
+        "shards":        n,
+        "image_size":    list(CONFIG["IMAGE_SIZE"]),
+        "class_indices": class_indices,
+        "files":         hashlib.blake2b(
+            "\n".join(df["filepath"] + "\t" + df["label"]).encode(),
+            digest_size=16).hexdigest(),
+    }
+
+    data_mtime = max(os.path.getmtime(os.path.join(CONFIG["DATA_DIR"], c))
+                     for c in df["label"].unique())
+    if (os.path.exists(manifest_path)
+            and os.path.getmtime(manifest_path) >= data_mtime
+            and all(os.path.exists(p) for p in shards)):
+        with open(manifest_path) as f:
+            if json.load(f) == manifest:
+                return shards
+
+    print(f"[INFO] Writing {split} TFRecords ({len(df)} images, {n} shards) …")
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    labels = df["label"].map(class_indices).values
+    ds = tf.data.Dataset.from_tensor_slices((df["filepath"].values, labels))
+    ds = ds.map(_load_image, num_parallel_calls=AUTOTUNE)
+
+    # Write to .tmp and move into place only once every shard is closed
+    writers = [tf.io.TFRecordWriter(p + ".tmp") for p in shards]
+    for i, (img, label) in enumerate(ds.as_numpy_iterator()):
+        example = tf.train.Example(features=tf.train.Features(feature={
+            "img":   tf.train.Feature(bytes_list=tf.train.BytesList(value=[img.tobytes()])),
+            "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)])),
+        }))
+        writers[i % n].write(example.SerializeToString())
+    for w in writers:
+        w.close()
+    for p in shards:
+        os.replace(p + ".tmp", p)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return shards
+
+
+def make_datasets(train_df, val_df, test_df):
+    """
+    tf.data pipelines: pre-decoded TFRecord shards read in parallel →
+    in-memory cache → shuffle → batch → gray-to-RGB → (augment) → prefetch.
+    JPEG decoding happens once, when the shards are written.
+    """
+    BS = CONFIG["BATCH_SIZE"]
+    class_indices = {c: i for i, c in enumerate(sorted(CONFIG["CLASSES"]))}
+
+    augment = models.Sequential([
+        layers.RandomFlip("horizontal"),
+        layers.RandomRotation(10 / 360, fill_mode="nearest"),
+        layers.RandomTranslation(0.08, 0.08, fill_mode="nearest"),
+        layers.RandomZoom(0.10, fill_mode="nearest"),
+    ], name="augment")
+
+    def to_inputs(training):
+        def fn(x, y):
+            # Cache holds 1 channel; expand here so the model gets RGB directly
+            x = tf.image.grayscale_to_rgb(tf.cast(x, tf.float32) / 255.0)
+            if training:
+                x = augment(x, training=True)
+            return x, tf.one_hot(y, CONFIG["NUM_CLASSES"])
+        return fn
+
+    def build(df, split, training):
+        shards = write_tfrecords(df, split, class_indices)
+        ds = tf.data.Dataset.from_tensor_slices(shards).interleave(
+            tf.data.TFRecordDataset, cycle_length=len(shards),
+            num_parallel_calls=AUTOTUNE)
+        ds = ds.map(_parse_example, num_parallel_calls=AUTOTUNE).cache()
+        if training:
+            ds = ds.shuffle(4096, seed=CONFIG["SEED"],
+                            reshuffle_each_iteration=True)
+        ds = ds.batch(BS).map(to_inputs(training), num_parallel_calls=AUTOTUNE)
+        return ds.prefetch(AUTOTUNE)
+
+    return (build(train_df, "train", True), build(val_df, "val", False),
+            build(test_df, "test", False), class_indices)
 
 
 def get_class_weights(train_df):
@@ -118,38 +233,40 @@ def get_class_weights(train_df):
     return dict(enumerate(weights_arr))
 
 
-def build_model(num_classes):
+def build_network(num_classes, weights="imagenet"):
     """
-    Input: (224, 224, 1) grayscale
-    → Repeat channels to get (224, 224, 3)
-    → EfficientNetB0 (ImageNet weights)
+    Input: (224, 224, 3) — grayscale replicated to RGB by the data pipeline
+    → EfficientNetB0 (ImageNet weights unless weights=None)
     → Classification head
+    Uncompiled; see build_model for the training-ready version.
     """
     from tensorflow.keras.applications import EfficientNetB0
 
-    # Grayscale input
-    inputs = tf.keras.Input(shape=(*CONFIG["IMAGE_SIZE"], 1), name="grayscale_input")
-
-    # Replicate single channel → 3 channels so EfficientNet works
-    x = layers.Lambda(lambda t: tf.repeat(t, 3, axis=-1), name="gray_to_rgb")(inputs)
+    inputs = tf.keras.Input(shape=(*CONFIG["IMAGE_SIZE"], 3), name="rgb_input")
 
     # EfficientNetB0 backbone
     base = EfficientNetB0(
         include_top=False,
-        weights="imagenet",
+        weights=weights,
         input_shape=(*CONFIG["IMAGE_SIZE"], 3),
     )
     base.trainable = False
 
-    x = base(x, training=False)
+    x = base(inputs, training=False)
     x = layers.GlobalAveragePooling2D()(x)
     x = layers.BatchNormalization()(x)
     x = layers.Dropout(CONFIG["DROPOUT"])(x)
     x = layers.Dense(256, activation="relu")(x)
     x = layers.Dropout(CONFIG["DROPOUT"] / 2)(x)
-    outputs = layers.Dense(num_classes, activation="softmax")(x)
+    # float32 head keeps softmax and the loss numerically stable under AMP
+    outputs = layers.Dense(num_classes, activation="softmax", dtype="float32")(x)
 
     model = models.Model(inputs, outputs, name="PulmoScan_EfficientNetB0")
+    return model, base
+
+
+def build_model(num_classes):
+    model, base = build_network(num_classes)
     model.compile(
         optimizer=optimizers.Adam(CONFIG["LEARNING_RATE"]),
         loss="categorical_crossentropy",
@@ -159,7 +276,7 @@ def build_model(num_classes):
     return model, base
 
 
-def train(model, base_model, train_flow, val_flow, class_weights):
+def train(model, base_model, train_ds, val_ds, class_weights):
     checkpoint_path = os.path.join(CONFIG["MODEL_DIR"], "best_model.keras")
 
     cbs = [
@@ -176,7 +293,7 @@ def train(model, base_model, train_flow, val_flow, class_weights):
 
     print("\n[PHASE 1] Training classification head (base frozen) …")
     h1 = model.fit(
-        train_flow, validation_data=val_flow,
+        train_ds, validation_data=val_ds,
         epochs=CONFIG["EPOCHS_PHASE1"],
         class_weight=class_weights, callbacks=cbs,
     )
@@ -194,7 +311,7 @@ def train(model, base_model, train_flow, val_flow, class_weights):
     )
 
     h2 = model.fit(
-        train_flow, validation_data=val_flow,
+        train_ds, validation_data=val_ds,
         epochs=CONFIG["EPOCHS_PHASE2"],
         class_weight=class_weights, callbacks=cbs,
     )
@@ -205,13 +322,13 @@ def train(model, base_model, train_flow, val_flow, class_weights):
     return combined
 
 
-def evaluate(model, test_flow, class_names):
-    test_flow.reset()
-    y_pred_prob = model.predict(test_flow, verbose=1)
+def evaluate(model, test_ds, class_indices, class_names):
+    # test_ds is cached and unshuffled, so both passes see the same order
+    y_pred_prob = model.predict(test_ds, verbose=1)
     y_pred      = np.argmax(y_pred_prob, axis=1)
-    y_true      = test_flow.classes
+    y_true      = np.concatenate([np.argmax(y, axis=1) for _, y in test_ds])
 
-    idx2label     = {v: k for k, v in test_flow.class_indices.items()}
+    idx2label     = {v: k for k, v in class_indices.items()}
     y_pred_labels = [idx2label[i] for i in y_pred]
     y_true_labels = [idx2label[i] for i in y_true]
 
@@ -273,6 +390,31 @@ def plot_history(history):
     plt.close()
 
 
+def export_tflite(model):
+    """
+    Float16 weight quantization only — full int8 is frequently slower
+    than FP32 on x86 CPUs, so it is deliberately not used here.
+    """
+    # TFLite has no bf16 conv kernels and float16 quantization expects an
+    # FP32 graph, so convert a float32 rebuild carrying the trained weights
+    policy = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy("float32")
+    try:
+        # Weights are overwritten below, so skip the ImageNet download
+        fp32_model, _ = build_network(CONFIG["NUM_CLASSES"], weights=None)
+        fp32_model.set_weights(model.get_weights())
+    finally:
+        tf.keras.mixed_precision.set_global_policy(policy)
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(fp32_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]
+    tflite_path = os.path.join(CONFIG["MODEL_DIR"], "pulmoscan_model.tflite")
+    with open(tflite_path, "wb") as f:
+        f.write(converter.convert())
+    print(f"[INFO] TFLite (float16) model saved to {tflite_path}")
+
+
 def save_artefacts(model, class_indices):
     model.save(os.path.join(CONFIG["MODEL_DIR"], "pulmoscan_model.keras"))
     label_map = {v: k for k, v in class_indices.items()}
@@ -285,6 +427,8 @@ def save_artefacts(model, class_indices):
             "num_classes": CONFIG["NUM_CLASSES"],
         }, f, indent=2)
     print(f"[INFO] Model saved to {CONFIG['MODEL_DIR']}/")
+    # Last, so a conversion failure can't leave the JSON artefacts missing
+    export_tflite(model)
 
 
 def main():
@@ -300,19 +444,20 @@ def main():
     train_df, val_df, test_df = stratified_split(df)
     print(f"[INFO] Train: {len(train_df)} | Val: {len(val_df)} | Test: {len(test_df)}")
 
-    train_flow, val_flow, test_flow = make_generators(train_df, val_df, test_df)
+    train_ds, val_ds, test_ds, class_indices = make_datasets(
+        train_df, val_df, test_df)
     class_weights = get_class_weights(train_df)
     print("[INFO] Class weights:", class_weights)
 
     model, base_model = build_model(CONFIG["NUM_CLASSES"])
-    history = train(model, base_model, train_flow, val_flow, class_weights)
+    history = train(model, base_model, train_ds, val_ds, class_weights)
     plot_history(history)
 
     print("\n[INFO] Evaluating best checkpoint …")
     best = tf.keras.models.load_model(
         os.path.join(CONFIG["MODEL_DIR"], "best_model.keras"))
-    evaluate(best, test_flow, CONFIG["CLASSES"])
-    save_artefacts(best, train_flow.class_indices)
+    evaluate(best, test_ds, class_indices, CONFIG["CLASSES"])
+    save_artefacts(best, class_indices)
 
     print("\n✅ Training complete!")
 